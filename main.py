@@ -1,79 +1,275 @@
 from contextlib import contextmanager
 from dataclasses import dataclass
-from datetime import datetime, timedelta, UTC
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
 import keyboard
 import logging
+import os
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
+import pickle
+import queue
+import re
+import subprocess
 import time
 import threading
-import toml
-from typing import List, Optional, Self, Union
+import tomllib
+from typing import Callable, Dict, List, Optional, Self, Union
 from selenium import webdriver
+from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.webdriver import WebDriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 
 
+class LogFormatter(logging.Formatter):
+    def format(self, record):
+        if getattr(record, 'plain', False):
+            return record.getMessage()
+        return super().format(record)
+
+
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    # Records collect in a large write buffer and only reach the disk when a
+    # record marked for flushing (the end of a scrape cycle) is written or the
+    # file is rotated
+    def _open(self):
+        stream = open(self.baseFilename, self.mode, buffering=1 << 17,
+                      encoding=self.encoding, errors=self.errors)
+        self.bytes_written = os.fstat(stream.fileno()).st_size
+        return stream
+
+    def shouldRollover(self, record):
+        return self.maxBytes > 0 and self.bytes_written >= self.maxBytes
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            if self.shouldRollover(record):
+                self.doRollover()
+            msg = self.format(record) + self.terminator
+            self.stream.write(msg)
+            self.bytes_written += len(msg.encode('utf-8'))
+            # Flushed here, on the thread that wrote the record
+            if getattr(record, 'flush', False):
+                self.stream.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+
 # Set up logging
-logging.basicConfig(level=logging.INFO,
-                    format='[%(asctime)s.%(msecs)03d] - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(LogFormatter(
+    '[%(asctime)s.%(msecs)03d] - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+logging.basicConfig(level=logging.INFO, handlers=[console_handler])
 logger = logging.getLogger(__name__)
 
 exit_flag = threading.Event()
 
-Max_SIZE = 50*1024
+SNAPSHOT_FILE = "snapshot.txt"
 
+# How long plain element lookups wait for the element to appear
+IMPLICIT_WAIT_SEC = 10
 
-def check_for_exit():
-    while not exit_flag.is_set():
-        if keyboard.is_pressed('esc'):
-            logger.info("Esc pressed")
-            exit_flag.set()
-        time.sleep(0.1)
+# Output files stay open for the whole run, keyed by path
+data_fds: Dict[Path, int] = {}
+# Digest of what was last written to each output file
+data_hashes: Dict[Path, bytes] = {}
 
+# India has no DST, so a fixed offset is exact and needs no tz database
+# (zoneinfo would need the tzdata package on Windows)
+IST_OFFSET = timedelta(hours=5, minutes=30)
+IST = timezone(IST_OFFSET, "IST")
 
-def get_time() -> str:
-    return (datetime.now(UTC) + timedelta(hours=5, minutes=30)).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
 
+def on_exit_key():
+    logger.info("Esc pressed")
+    exit_flag.set()
 
-def append_to_file(file_path: Path, text: str):
-    max_size = Max_SIZE
-    line = "------------------------------------"
 
-    # Check if file exists and its size
-    if file_path.exists() and file_path.stat().st_size > max_size:
-        with open(file_path, 'r+', encoding='utf-8') as file:
-            content = file.read()
-            # Find the indices of the first two '-------------'
-            first_sep = content.find(line)
-            second_sep = content.find(
-                line, first_sep + len(line))
+def _make_get_time():
+    # Only re-run strftime when the second changes; milliseconds are appended
+    cache = (None, "")
 
-            # If two separators are found, remove content between them
-            if first_sep != -1 and second_sep != -1:
-                content = content[:first_sep] + content[second_sep:]
-                file.seek(0)
-                file.write(content)
-                file.truncate()
+    def get_time() -> str:
+        nonlocal cache
+        now = datetime.now(IST)
+        second = now.replace(microsecond=0)
+        if cache[0] != second:
+            cache = (second, second.strftime("%Y-%m-%d %H:%M:%S"))
+        return f"{cache[1]}.{now.microsecond // 1000:03d}"
 
-    # Append the new text at the end of the file
-    with open(file_path, 'a', encoding='utf-8') as file:
-        file.write(f"{text}\n")
+    return get_time
 
 
-def print_with_log(item, file_path: Path, time_req: bool, level):
+get_time = _make_get_time()
+
+
+@contextmanager
+def explicit_wait(driver: WebDriver):
+    # WebDriverWait polls find_element, which would otherwise also block for the
+    # implicit wait on every poll, so it is switched off for the duration
+    driver.implicitly_wait(0)
+    try:
+        yield WebDriverWait(driver, 10)
+    finally:
+        driver.implicitly_wait(IMPLICIT_WAIT_SEC)
+
+
+def click_tab(driver: WebDriver, tab_selector: str):
+    with explicit_wait(driver) as wait:
+        wait.until(EC.element_to_be_clickable(
+            (By.CSS_SELECTOR, tab_selector))).click()
+    # Lets READ_ALL_JS know which tab is open without clicking it again
+    driver.execute_script("window.__scraperTab = arguments[0];", tab_selector)
+
+
+# Resolves a selector with querySelector once and remembers the element's id
+# on the page, so later lookups go through getElementById instead
+FIND_ELEMENT_JS = """(selector) => {
+    const ids = window.__scraperIds || (window.__scraperIds = {});
+    let e = ids[selector] && document.getElementById(ids[selector]);
+    // Tabs can share selectors, so only trust a cached element that still matches
+    if (!e || !e.isConnected || !e.matches(selector)) {
+        e = document.querySelector(selector);
+        if (e && e.id && document.getElementById(e.id) === e) {
+            ids[selector] = e.id;
+        }
+    }
+    return e;
+}"""
+
+# Reads the text of every selector in a single WebDriver round-trip
+READ_TEXTS_JS = """
+const find = """ + FIND_ELEMENT_JS + """;
+return arguments[0].map(s => {
+    const e = find(s);
+    return e ? e.innerText : null;
+});
+"""
+
+
+def read_texts(driver: WebDriver, selectors: List[str]) -> List[str]:
+    # Wait (implicitly) for the tab to render, then grab all values at once
+    driver.find_element(By.CSS_SELECTOR, selectors[0])
+    try:
+        texts = driver.execute_script(READ_TEXTS_JS, selectors)
+        if texts is not None and None not in texts:
+            return texts
+    except WebDriverException:
+        pass
+
+    # Fall back to looking up each element individually
+    return [driver.find_element(By.CSS_SELECTOR, selector).text for selector in selectors]
+
+
+# Walks every master tab in turn and reads all sites' values inside the page,
+# so a whole tick costs a single CDP round-trip
+READ_ALL_JS = """
+(async (groups, find) => {
+    const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+    const read = s => {
+        const e = find(s);
+        return e ? e.innerText : null;
+    };
+    const out = [];
+    const stuck = new Set();
+    for (const [tab, selectors] of groups) {
+        if (stuck.has(tab)) {
+            out.push(selectors.map(() => null));
+            continue;
+        }
+        // window.__scraperTab is the tab last seen open, here or by click_tab()
+        if (window.__scraperTab !== tab) {
+            // Tabs share cell selectors, so wait for the cell found before the
+            // click to be replaced, not just for any match
+            const before = find(selectors[0]);
+            window.__scraperTab = null;
+            document.querySelector(tab).click();
+            const deadline = Date.now() + 10000;
+            let e;
+            do {
+                await sleep(100);
+                e = find(selectors[0]);
+            } while ((!e || e === before) && Date.now() < deadline);
+            if (!e || e === before) {
+                // The tab did not switch, leave its sites to the fallback
+                stuck.add(tab);
+                out.push(selectors.map(() => null));
+                continue;
+            }
+            window.__scraperTab = tab;
+        }
+        out.push(selectors.map(read));
+    }
+    return JSON.stringify(out);
+})(%s, """ + FIND_ELEMENT_JS + """)
+"""
+
+
+def build_read_all_expression(sites: List["Station"]) -> str:
+    return READ_ALL_JS % json.dumps(
+        [[site.tab_selector, site.param_selectors] for site in sites])
+
+
+def read_all_sites(driver: WebDriver, expression: str) -> List[List[Optional[str]]]:
+    response = driver.execute_cdp_cmd("Runtime.evaluate", {
+        "expression": expression,
+        "awaitPromise": True,
+        "returnByValue": True
+    })
+    if "exceptionDetails" in response:
+        raise WebDriverException(
+            response["exceptionDetails"].get("text", "Runtime.evaluate failed"))
+    return json.loads(response["result"]["value"])
+
+
+def print_with_log(item, time_req: bool, level, flush: bool = False):
+    # Untimed lines (the separators) are written without any prefix
+    extra = {'plain': not time_req, 'flush': flush}
     match level:
-        case 'info':
-            logger.info(item)
         case 'error':
-            logger.error(item)
+            logger.error(item, extra=extra)
         case _:
-            print(item)
-    if time_req:
-        item = f"[{get_time()}]: {item}"
-    append_to_file(file_path=file_path, text=item)
+            logger.info(item, extra=extra)
+
+
+def write_data(file_path: Path, text: str):
+    data = text.encode('utf-8')
+    # Skip the write when the contents are the same as last tick
+    digest = hashlib.blake2b(data, digest_size=8).digest()
+    if data_hashes.get(file_path) == digest:
+        return
+
+    fd = data_fds.get(file_path)
+    if fd is None:
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT |
+                     getattr(os, 'O_BINARY', 0), 0o644)
+        data_fds[file_path] = fd
+    # Overwrite in place, then cut off whatever is left of the old contents
+    os.lseek(fd, 0, os.SEEK_SET)
+    os.write(fd, data)
+    os.ftruncate(fd, len(data))
+    data_hashes[file_path] = digest
+
+
+def close_data_files():
+    for fd in data_fds.values():
+        os.close(fd)
+    data_fds.clear()
+    data_hashes.clear()
+
+
+def escape_braces(text: str) -> str:
+    # Make text safe to embed in a str.format template
+    return text.replace('{', '{{').replace('}', '}}')
 
 
 @dataclass(slots=True)
@@ -94,12 +290,24 @@ class SiteData():
     caaqms_cems_master_selector: str
     eqms_master_selector: str
 
+    def __post_init__(self):
+        # Turn the $item/$tab/$param placeholders into str.format fields
+        for name in ('master_tab_selector', 'caaqms_cems_title_selector',
+                     'caaqms_cems_master_selector', 'eqms_master_selector'):
+            template = escape_braces(getattr(self, name))
+            setattr(self, name, template.replace('$item', '{item}').replace(
+                '$tab', '{tab}').replace('$param', '{param}'))
+
 
 @dataclass(slots=True)
 class OutData():
     data_out: Path
     log_out: Path
 
+    def __post_init__(self):
+        self.data_out = Path(self.data_out)
+        self.log_out = Path(self.log_out)
+
 
 @dataclass(slots=True)
 class ConfigData():
@@ -109,271 +317,310 @@ class ConfigData():
     loop_time_sec: float
     log_size_kb: int
 
+    def __post_init__(self):
+        # Enforce the minimum loop time and log size; the log size is kept in bytes
+        self.loop_time_sec = max(float(self.loop_time_sec), 30)
+        self.log_size_kb = max(int(self.log_size_kb), 50)*1024
+
     @classmethod
     def read(cls, file_path='config.toml') -> Union[Self, Exception]:
         try:
-            with open(file_path, "r") as f:
-                config = toml.load(f)
-
-            out_data = OutData(
-                data_out=Path(config["data_out"]["output"]),
-                log_out=Path(config["data_out"]["log"])
-            )
-
-            login_data = LoginData(**config["login"])
-            site_data = SiteData(**config["site"])
-            loop_time_sec = max(
-                float(config["application"]["loop_time_sec"]), 30)
-            log_size_kb = max(
-                int(config["application"]["log_size_kb"]), 50)*1024
-
-            return ConfigData(
-                login_data=login_data,
-                site_data=site_data,
-                output=out_data,
-                loop_time_sec=loop_time_sec,
-                log_size_kb=log_size_kb
-            )
+            return _load_cached(Path(file_path))
 
         except Exception as e:
             logger.error(f"Error reading config: {str(e)}")
             raise
 
+    @classmethod
+    def from_dict(cls, config: dict) -> Self:
+        return cls(
+            login_data=LoginData(**config["login"]),
+            site_data=SiteData(**config["site"]),
+            output=OutData(
+                data_out=config["data_out"]["output"],
+                log_out=config["data_out"]["log"]
+            ),
+            loop_time_sec=config["application"]["loop_time_sec"],
+            log_size_kb=config["application"]["log_size_kb"]
+        )
+
+
+# Bump whenever ConfigData or its parsing changes, to invalidate old caches
+CONFIG_CACHE_VERSION = 2
+
+
+def _load_cached(file_path: Path) -> ConfigData:
+    data = file_path.read_bytes()
+    key = (CONFIG_CACHE_VERSION, file_path.stat().st_mtime_ns,
+           hashlib.blake2b(data, digest_size=8).hexdigest())
+    cache_path = file_path.with_name(file_path.name + ".cache.pkl")
+
+    try:
+        with open(cache_path, 'rb') as f:
+            if pickle.load(f) == key:
+                return pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable config cache: {str(e)}")
+
+    config = ConfigData.from_dict(tomllib.loads(data.decode('utf-8')))
+
+    try:
+        with open(cache_path, 'wb') as f:
+            pickle.dump(key, f)
+            pickle.dump(config, f)
+    except OSError as e:
+        logger.warning(f"Could not write config cache: {str(e)}")
+
+    return config
+
+
+# First whitespace-separated token that is a plain number, e.g. "12.3 μg/m³"
+NUMBER_RE = re.compile(r"(?<!\S)[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?!\S)")
+
 
 class Param:
     __slots__ = ['value_raw', 'value_parsed',
-                 'unit', 'is_health_ok', 'update_time']
+                 'unit', 'is_health_ok', 'update_time', '_str']
 
     def __init__(self, unit: str):
         self.value_raw: Optional[str] = None
         self.value_parsed: Optional[float] = None
         self.unit: str = unit
         self.is_health_ok: bool = False
-        self.update_time = get_time()
-
-    def set_float_check_value(self, value: str):
+        self.update_time: Optional[str] = None
+        self._str: Optional[str] = None
+
+    def set_float_check_value(self, value: str, now: str):
+        self.update_time = now
+        # Same raw text parses to the same value, keep the cached string
+        if value == self.value_raw:
+            return
         self.value_raw = value
-        self.update_time = get_time()
-        try:
-            self.value_parsed = next(
-                float(x) for x in value.split() if x.replace('.', '').isdigit())
+        self._str = None
+        # Fast path: the reading usually leads, e.g. "12.3 μg/m³". float() also
+        # takes "1e3", "1_000", "nan" and "inf", which NUMBER_RE rejects, so
+        # only plain tokens are tried here
+        parts = value.split(None, 1)
+        parsed = None
+        if parts:
+            head = parts[0]
+            if ((head[-1].isdigit() or head[-1] == '.')
+                    and '_' not in head and 'e' not in head and 'E' not in head):
+                try:
+                    parsed = float(head)
+                except ValueError:
+                    pass
+        if parsed is None:
+            match = NUMBER_RE.search(value)
+            parsed = float(match.group()) if match else None
+
+        if parsed is not None:
+            self.value_parsed = parsed
             self.is_health_ok = True
-        except StopIteration:
+        else:
             self.is_health_ok = False
 
     def __str__(self):
-        if self.value_raw is None:
-            return "Uninitialized - No Value fetched"
-        elif not self.is_health_ok:
-            return f'Invalid Data - Raw value: "{self.value_raw}"'
-        else:
-            return f"{self.value_parsed} {self.unit}"
-
-
-class Caaqms:
-    def __init__(self, name, config: ConfigData, selector_idx: int):
+        if self._str is None:
+            if self.value_raw is None:
+                self._str = "Uninitialized - No Value fetched"
+            elif not self.is_health_ok:
+                self._str = f'Invalid Data - Raw value: "{self.value_raw}"'
+            else:
+                self._str = f"{self.value_parsed} {self.unit}"
+        return self._str
+
+
+# (key, unit) of each parameter, in the order the dashboard lists them
+CAAQMS_PARAMS = (
+    ('co', "mg/m³"),
+    ('co2', "ppm"),
+    ('nox', "μg/m³"),
+    ('pm10', "μg/m³"),
+    ('pm2_5', "μg/m³"),
+    ('so2', "μg/m³")
+)
+
+CEMS_PARAMS = (
+    ('nox', "mg/nm³"),
+    ('pm', "mg/nm³"),
+    ('so2', "mg/nm³")
+)
+
+EQMS_PARAMS = (
+    ('bod_toc', "mg/L"),
+    ('cod_toc', "mg/L"),
+    ('ph', "pH"),
+    ('toc', "mg/L"),
+    ('tss', "mg/L"),
+    ('temperature', "°C")
+)
+
+
+def caaqms_unit(title: str) -> Optional[str]:
+    suffix = title.split('_')[-1]
+    return suffix.upper().lstrip() if suffix.upper().isprintable() else None
+
+
+def cems_unit(title: str) -> Optional[str]:
+    suffix = title.split('_')[-1]
+    return str(int(suffix)) if suffix.isdigit() else None
+
+
+class Station:
+    def __init__(self, name, config: ConfigData, tab_index: int, params_spec, param_template: str,
+                 item: Optional[int] = None, parse_unit: Optional[Callable[[str], Optional[str]]] = None,
+                 heading: str = "DATA"):
         self.name: str = name
-        self.selector: str = config.site_data.caaqms_cems_master_selector.replace(
-            "$item", str(selector_idx))
-        self.selector_idx = selector_idx
-        self.unit = None
-        self.params = {
-            'co': Param("mg/m³"),
-            'co2': Param("ppm"),
-            'nox': Param("μg/m³"),
-            'pm10': Param("μg/m³"),
-            'pm2_5': Param("μg/m³"),
-            'so2': Param("μg/m³")
-        }
+        self.heading: str = heading
+        self.parse_unit = parse_unit
+        self.unit: Optional[str] = None
+        self.params = {key: Param(unit) for key, unit in params_spec}
+        self.tab_selector: str = config.site_data.master_tab_selector.format_map(
+            {"tab": tab_index})
+        # Stations with a unit parser get their name suffix from a title cell
+        self.title_selector: Optional[str] = config.site_data.caaqms_cems_title_selector.format_map(
+            {"item": item}) if parse_unit is not None else None
+        self.param_selectors: List[str] = [
+            param_template.format_map({"item": item, "param": i})
+            for i in range(1, len(self.params) + 1)]
+        self.data_path: Path = config.output.data_out / f"{self.name}.txt"
+        self._template: str = self._build_template()
+
+    def _build_template(self) -> str:
+        # e.g. "ETP Data:- BOD_TOC: {}, COD_TOC: {}, ..." filled with the params
+        return escape_braces(f"{self.name} {self.heading}:- ") + ", ".join(
+            f"{escape_braces(k.upper())}: {{}}" for k in self.params)
 
     def __str__(self):
-        return f"{self.name} DATA:- " + ", ".join(f"{k.upper()}: {v}" for k, v in self.params.items())
-
-    def fetch_data(self, driver: WebDriver, file_name, config: ConfigData):
-        try:
-            WebDriverWait(driver, 10).until(EC.element_to_be_clickable(
-                (By.CSS_SELECTOR, config.site_data.master_tab_selector.replace("$tab", "1")))).click()
-
-            if self.unit is None:
-                pre = WebDriverWait(driver, 10).until(EC.visibility_of_element_located(
-                    (By.CSS_SELECTOR, config.site_data.caaqms_cems_title_selector.replace("$item", str(self.selector_idx))))).text
-                x = str(
-                    pre.split('_')[-1]).upper().lstrip() if pre.split('_')[-1].upper().isprintable() else None
-                if x is not None:
-                    self.unit = x
-                    self.name = self.name + self.unit
-                    file_name = self.name + ".txt"
+        return self._template.format(*self.params.values())
 
-            for i, (param_name, param) in enumerate(self.params.items(), 1):
-                value = WebDriverWait(driver, 10).until(EC.visibility_of_element_located(
-                    (By.CSS_SELECTOR, self.selector.replace("$param", str(i))))).text
-                param.set_float_check_value(value)
+    def needs_tab(self, texts: Optional[List[Optional[str]]]) -> bool:
+        # The station is read from its own tab when the bulk read has nothing
+        # for it, or the unit title is still unknown
+        return ((self.parse_unit is not None and self.unit is None)
+                or texts is None or None in texts)
 
-            print_with_log(f"{self}", config.output.log_out, True, 'info')
-
-            with open(config.output.data_out / file_name, 'w', encoding='utf-8') as f:
-                f.write(str(self))
-
-        except Exception as e:
-            print_with_log(f"Error fetching data for {self.name}: {
-                           str(e)}", config.output.log_out, True, 'error')
-
-
-class Cems:
-    def __init__(self, name, config: ConfigData, selector_idx: int):
-        self.name: str = name
-        self.selector: str = config.site_data.caaqms_cems_master_selector.replace(
-            "$item", str(selector_idx))
-        self.selector_idx = selector_idx
-        self.unit = None
-        self.params = {
-            'nox': Param("mg/nm³"),
-            'pm': Param("mg/nm³"),
-            'so2': Param("mg/nm³")
-        }
-
-    def __str__(self):
-        return f"{self.name} DATA:- " + ", ".join(f"{k.upper()}: {v}" for k, v in self.params.items())
-
-    def fetch_data(self, driver: WebDriver, file_name: str, config: ConfigData):
+    def fetch_data(self, driver: WebDriver, now: str,
+                   texts: Optional[List[Optional[str]]] = None) -> Optional[str]:
+        # Expects the station's tab to be open already when needs_tab(texts)
         try:
-            WebDriverWait(driver, 10).until(EC.element_to_be_clickable(
-                (By.CSS_SELECTOR, config.site_data.master_tab_selector.replace("$tab", "2")))).click()
-
-            if self.unit is None:
-                pre = WebDriverWait(driver, 10).until(EC.visibility_of_element_located(
-                    (By.CSS_SELECTOR, config.site_data.caaqms_cems_title_selector.replace("$item", str(self.selector_idx))))).text
-                x = int(
-                    pre.split('_')[-1]) if pre.split('_')[-1].isdigit() else None
-                if x is not None:
-                    self.unit = x
-                    self.name = self.name + str(x)
-                    file_name = self.name + ".txt"
-
-            for i, (param_name, param) in enumerate(self.params.items(), 1):
-                value = WebDriverWait(driver, 10).until(EC.visibility_of_element_located(
-                    (By.CSS_SELECTOR, self.selector.replace("$param", str(i))))).text
-                param.set_float_check_value(value)
-
-            print_with_log(f"{self}", config.output.log_out, True, 'info')
-
-            with open(config.output.data_out / file_name, 'w', encoding='utf-8') as f:
-                f.write(str(self))
-        except Exception as e:
-            print_with_log(f"Error fetching data for {self.name}: {
-                           str(e)}", config.output.log_out, True, 'error')
-
-
-class Eqms:
-    def __init__(self, name, selector):
-        self.name: str = name
-        self.selector: str = selector
-        self.params = {
-            'bod_toc': Param("mg/L"),
-            'cod_toc': Param("mg/L"),
-            'ph': Param("pH"),
-            'toc': Param("mg/L"),
-            'tss': Param("mg/L"),
-            'temperature': Param("°C")
-        }
-
-    def __str__(self):
-        return f"{self.name} Data:- " + ", ".join(f"{k.upper()}: {v}" for k, v in self.params.items())
+            if self.parse_unit is not None and self.unit is None:
+                # Read the title in the same call as the parameters
+                title, *texts = read_texts(
+                    driver, [self.title_selector, *self.param_selectors])
+                self.unit = self.parse_unit(title)
+                if self.unit is not None:
+                    self.name = self.name + self.unit
+                    self._template = self._build_template()
+                    self.data_path = self.data_path.with_name(
+                        self.name + ".txt")
+            elif texts is None or None in texts:
+                texts = read_texts(driver, self.param_selectors)
 
-    def fetch_data(self, driver: WebDriver, file_name: str, config: ConfigData):
-        try:
-            WebDriverWait(driver, 10).until(EC.element_to_be_clickable(
-                (By.CSS_SELECTOR, config.site_data.master_tab_selector.replace("$tab", "3")))).click()
+            for param, value in zip(self.params.values(), texts):
+                param.set_float_check_value(value, now)
 
-            for i, (param_name, param) in enumerate(self.params.items(), 1):
-                value = WebDriverWait(driver, 10).until(EC.visibility_of_element_located(
-                    (By.CSS_SELECTOR, self.selector.replace("$param", str(i))))).text
-                param.set_float_check_value(value)
+            data = str(self)
+            print_with_log(data, True, 'info')
 
-            print_with_log(f"{self}", config.output.log_out, True, 'info')
+            write_data(self.data_path, data)
+            return data
 
-            with open(config.output.data_out / file_name, 'w', encoding='utf-8') as f:
-                f.write(str(self))
         except Exception as e:
             print_with_log(f"Error fetching data for {self.name}: {
-                           str(e)}", config.output.log_out, True, 'error')
+                           str(e)}", True, 'error')
+
+
+CHROME_FLAGS = (
+    "--headless",  # Run in headless mode
+    "--no-sandbox",
+    "--incognito",
+    "--disable-gpu",
+    "--disable-gpu-compositing",
+    "--disable-image-loading",
+    "--disable-bundled-plugins",
+    "--disable-flash",
+    "--disable-save-password-bubble",
+    "--mute-audio",
+    "--disable-extensions",
+    "--disable-default-apps",
+    "--no-default-browser-check",
+    "--disable-infobars",
+    "--disable-media-stream",
+    "--disable-dev-tools",
+    "--no-first-run",
+    "--disable-blink-features=AutomationControlled",
+    "--blink-settings=imagesEnabled=false",
+    "--ignore-certificate-errors",
+    # INFO = 0, WARNING = 1, LOG_ERROR = 2, LOG_FATAL = 3
+    "--log-level=3",
+    "--disable-translate",
+    "--disable-sync",
+    "--disable-notifications",
+    "--disable-autofill",
+    "--disable-speech-api",
+    "user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "--disable-dev-shm-usage",
+)
+
+CHROME_PREFS = {
+    "profile.managed_default_content_settings.images": 2,
+    "profile.default_content_setting_values.popups": 2,
+    "profile.default_content_setting_values.notifications": 2,
+    "profile.default_content_setting_values.geolocation": 2,
+    "profile.default_content_setting_values.media_stream_mic": 2,
+    "profile.default_content_setting_values.media_stream_camera": 2,
+    "profile.default_content_setting_values.automatic_downloads": 2,
+    "profile.default_content_setting_values.ppapi_broker": 2,
+    "profile.default_content_setting_values.ssl_cert_decisions": 2,
+    "profile.default_content_setting_values.auto_select_certificate": 2,
+    "profile.default_content_setting_values.mixed_script": 2,
+    "profile.default_content_setting_values.media_stream": 2,
+    "profile.default_content_setting_values.protocol_handlers": 2,
+    "profile.default_content_setting_values.plugins": 2,
+    "profile.default_content_setting_values.midi_sysex": 2,
+    "profile.default_content_setting_values.push_messaging": 2,
+    "profile.default_content_setting_values.metro_switch_to_desktop": 2,
+    "profile.default_content_setting_values.protected_media_identifier": 2,
+    "profile.default_content_setting_values.site_engagement": 2,
+}
 
 
 @contextmanager
 def start_browser_and_login(config: ConfigData):
     driver = None
     chrome_options = webdriver.ChromeOptions()
-    chrome_options.add_argument("--headless")  # Run in headless mode
-    chrome_options.add_argument("--no-sandbox")
-    chrome_options.add_argument("--incognito")
-    chrome_options.add_argument("--disable-gpu")
-    chrome_options.add_argument("--disable-gpu-compositing")
-    chrome_options.add_argument("--disable-image-loading")
-    chrome_options.add_argument("--disable-bundled-plugins")
-    chrome_options.add_argument("--disable-flash")
-    chrome_options.add_argument("--disable-save-password-bubble")
-    chrome_options.add_argument("--mute-audio")
-    chrome_options.add_argument("--disable-extensions")
-    chrome_options.add_argument("--disable-default-apps")
-    chrome_options.add_argument("--no-default-browser-check")
-    chrome_options.add_argument("--disable-infobars")
-    chrome_options.add_argument("--disable-media-stream")
-    chrome_options.add_argument("--disable-dev-tools")
-    chrome_options.add_argument("--no-first-run")
-    chrome_options.add_argument(
-        "--disable-blink-features=AutomationControlled")
-    chrome_options.add_argument("--blink-settings=imagesEnabled=false")
-    chrome_options.add_argument("--ignore-certificate-errors")
-    # INFO = 0, WARNING = 1, LOG_ERROR = 2, LOG_FATAL = 3
-    chrome_options.add_argument("--log-level=3")
-    chrome_options.add_argument("--disable-translate")
-    chrome_options.add_argument("--disable-sync")
-    chrome_options.add_argument("--disable-notifications")
-    chrome_options.add_argument("--disable-autofill")
-    chrome_options.add_argument("--disable-speech-api")
-    chrome_options.add_argument(
-        "user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
-    chrome_options.add_argument("--disable-dev-shm-usage")
-
-    prefs = {
-        "profile.managed_default_content_settings.images": 2,
-        "profile.default_content_setting_values.popups": 2,
-        "profile.default_content_setting_values.notifications": 2,
-        "profile.default_content_setting_values.geolocation": 2,
-        "profile.default_content_setting_values.media_stream_mic": 2,
-        "profile.default_content_setting_values.media_stream_camera": 2,
-        "profile.default_content_setting_values.automatic_downloads": 2,
-        "profile.default_content_setting_values.ppapi_broker": 2,
-        "profile.default_content_setting_values.ssl_cert_decisions": 2,
-        "profile.default_content_setting_values.auto_select_certificate": 2,
-        "profile.default_content_setting_values.mixed_script": 2,
-        "profile.default_content_setting_values.media_stream": 2,
-        "profile.default_content_setting_values.protocol_handlers": 2,
-        "profile.default_content_setting_values.plugins": 2,
-        "profile.default_content_setting_values.midi_sysex": 2,
-        "profile.default_content_setting_values.push_messaging": 2,
-        "profile.default_content_setting_values.metro_switch_to_desktop": 2,
-        "profile.default_content_setting_values.protected_media_identifier": 2,
-        "profile.default_content_setting_values.site_engagement": 2,
-    }
-    chrome_options.add_experimental_option("prefs", prefs)
-
-    driver = webdriver.Chrome(options=chrome_options)
+    for flag in CHROME_FLAGS:
+        chrome_options.add_argument(flag)
+    chrome_options.add_experimental_option("prefs", CHROME_PREFS)
+
+    service = Service()
+    if os.name == 'nt':
+        # Don't spawn a console window for chromedriver
+        service.creation_flags = subprocess.CREATE_NO_WINDOW
+
+    driver = webdriver.Chrome(service=service, options=chrome_options)
+    # Element lookups wait inside the browser instead of polling from here
+    driver.implicitly_wait(IMPLICIT_WAIT_SEC)
     try:
         driver.get(config.site_data.url)
 
-        WebDriverWait(driver, 10).until(EC.presence_of_element_located(
-            (By.CSS_SELECTOR, config.site_data.login_form))).send_keys(
-            config.login_data.email + Keys.RETURN)
+        with explicit_wait(driver) as wait:
+            wait.until(EC.presence_of_element_located(
+                (By.CSS_SELECTOR, config.site_data.login_form))).send_keys(
+                config.login_data.email + Keys.RETURN)
 
-        WebDriverWait(driver, 10).until(EC.element_to_be_clickable(
-            (By.CSS_SELECTOR, config.site_data.password_selector))).send_keys(
-            config.login_data.password + Keys.RETURN)
+            wait.until(EC.element_to_be_clickable(
+                (By.CSS_SELECTOR, config.site_data.password_selector))).send_keys(
+                config.login_data.password + Keys.RETURN)
 
         yield driver
     except Exception as e:
         print_with_log(f"Error during login: {
-                       str(e)}", config.output.log_out, True, 'error')
+                       str(e)}", True, 'error')
         raise
     finally:
         if driver is not None:
@@ -381,97 +628,180 @@ def start_browser_and_login(config: ConfigData):
             driver.quit()
 
 
+def setup_file_logging(config: ConfigData) -> BufferedRotatingFileHandler:
+    file_handler = BufferedRotatingFileHandler(
+        config.output.log_out, maxBytes=config.log_size_kb, backupCount=1, encoding='utf-8')
+    formatter = LogFormatter(
+        '[%(asctime)s.%(msecs)03d]: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    # Log file timestamps are in IST, like get_time()
+    ist_offset_sec = IST_OFFSET.total_seconds()
+    formatter.converter = lambda secs: time.gmtime(secs + ist_offset_sec)
+    file_handler.setFormatter(formatter)
+    # Only this module's records go to the log file
+    file_handler.addFilter(logging.Filter(logger.name))
+    return file_handler
+
+
+@contextmanager
+def queued_logging(file_handler: logging.Handler):
+    # Logging calls only enqueue the record; a listener thread formats it and
+    # writes it to the console and the log file
+    root = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    listener = QueueListener(log_queue, console_handler,
+                             file_handler, respect_handler_level=True)
+    root.removeHandler(console_handler)
+    root.addHandler(queue_handler)
+    listener.start()
+    try:
+        yield
+    finally:
+        listener.stop()
+        # Write out whatever is still buffered, e.g. the exit messages
+        file_handler.close()
+        root.removeHandler(queue_handler)
+        root.addHandler(console_handler)
+
+
 def main():
     logger.info("Press ESC to exit at any time.\n")
-    # Start the exit checker in a separate thread
-    exit_thread = threading.Thread(target=check_for_exit)
-    exit_thread.daemon = True
-    exit_thread.start()
+    # keyboard calls back from its own listener thread, no polling needed
+    try:
+        esc_hotkey = keyboard.add_hotkey('esc', on_exit_key)
+    except (ImportError, OSError) as e:
+        # Linux needs root and macOS needs permissions for the keyboard hook
+        logger.warning(f"Esc hotkey unavailable, stop with Ctrl+C: {str(e)}")
+        esc_hotkey = None
 
     try:
         config = ConfigData.read()
         logger.info("successfully read config file")
 
-        global Max_SIZE
-        Max_SIZE = config.log_size_kb
         config.output.data_out.mkdir(parents=True, exist_ok=True)
 
         config.output.log_out.mkdir(parents=True, exist_ok=True)
 
         config.output.log_out = Path(config.output.log_out/"log.txt")
+        log_file = setup_file_logging(config)
 
     except Exception as e:
         logger.error(f"Error during login: {str(e)}")
         exit()
 
-    caaqms_sites: List[Caaqms] = []
-    for i in range(1, 4):
-        caaqms_sites.append(
-            Caaqms(f"AAQMS ", config, i)
-        )
-
-    cems_units: List[Cems] = []
-    for i in range(1, 8):
-        cems_units.append(
-            Cems(f"CEMS UNIT# ", config, i)
-        )
-
-    eqms = Eqms("ETP", config.site_data.eqms_master_selector)
-
-    # driver = start_browser_and_login(config)
-    with start_browser_and_login(config) as driver:
-        logger.info("Driver initialisation succesful")
-
-        WebDriverWait(driver, 10).until(EC.element_to_be_clickable(
-            (By.CSS_SELECTOR, config.site_data.menu_content))).click()
-        WebDriverWait(driver, 10).until(EC.element_to_be_clickable(
-            (By.CSS_SELECTOR, config.site_data.dashboard))).click()
-
-        if (not config.output.log_out.exists()) or config.output.log_out.stat().st_size == 0:
-            print_with_log("------------------------------------",
-                           config.output.log_out, False, 'ignore')
-        print_with_log("Application Started.",
-                       config.output.log_out, True, 'info')
-        print_with_log("------------------------------------",
-                       config.output.log_out, False, 'ignore')
-
-        while not exit_flag.is_set():
-            start_time = time.time()
-
-            try:
-                for caaqms in caaqms_sites:
-                    caaqms.fetch_data(driver, f"{caaqms.name}.txt", config)
-
-                for cems in cems_units:
-                    cems.fetch_data(driver, f"{cems.name}.txt", config)
-
-                eqms.fetch_data(driver, "ETP.txt", config)
-
-                print_with_log("------------------------------------",
-                               config.output.log_out, False, 'ignore')
+    # From here on the console and log file are written by a background thread
+    with queued_logging(log_file):
+        # Checked before anything is buffered, so a new log starts with the separator
+        if log_file.bytes_written == 0:
+            print_with_log("------------------------------------", False, 'ignore')
+
+        sites: List[Station] = []
+        for i in range(1, 4):
+            sites.append(
+                Station("AAQMS ", config, 1, CAAQMS_PARAMS, config.site_data.caaqms_cems_master_selector,
+                        item=i, parse_unit=caaqms_unit)
+            )
 
-            except Exception as e:
-                print_with_log(f"Error occurred: {
-                               str(e)}", config.output.log_out, True, 'error')
+        for i in range(1, 8):
+            sites.append(
+                Station("CEMS UNIT# ", config, 2, CEMS_PARAMS, config.site_data.caaqms_cems_master_selector,
+                        item=i, parse_unit=cems_unit)
+            )
 
-            # Calculate remaining time to sleep
-            elapsed_time = time.time() - start_time
-            sleep_time = max(0, config.loop_time_sec - elapsed_time)
+        sites.append(
+            Station("ETP", config, 3, EQMS_PARAMS,
+                    config.site_data.eqms_master_selector, heading="Data")
+        )
 
-            # Sleep in short intervals, checking the running flag
-            for _ in range(int(sleep_time / 0.5)):
-                time.sleep(0.5)
-                if exit_flag.is_set():
-                    break
+        sites_by_tab: Dict[str, List[Station]] = {}
+        for site in sites:
+            sites_by_tab.setdefault(site.tab_selector, []).append(site)
 
-    print_with_log("Received Esc, Preparing to exit...",
-                   config.output.log_out, True, 'info')
-    print_with_log("------------------------------------",
-                   config.output.log_out, False, 'ignore')
+        read_all_expression = build_read_all_expression(sites)
+        snapshot_path = config.output.data_out / SNAPSHOT_FILE
 
-    print_with_log(f"Application Ended", config.output.log_out, True, 'info')
-    print_with_log("------------------------------------",
-                   config.output.log_out, False, 'ignore')
+        try:
+            # driver = start_browser_and_login(config)
+            with start_browser_and_login(config) as driver:
+                logger.info("Driver initialisation succesful")
+
+                with explicit_wait(driver) as wait:
+                    wait.until(EC.element_to_be_clickable(
+                        (By.CSS_SELECTOR, config.site_data.menu_content))).click()
+                    wait.until(EC.element_to_be_clickable(
+                        (By.CSS_SELECTOR, config.site_data.dashboard))).click()
+
+                print_with_log("Application Started.", True, 'info')
+                print_with_log("------------------------------------", False, 'ignore')
+
+                while not exit_flag.is_set():
+                    start_time = time.time()
+
+                    try:
+                        try:
+                            site_texts = read_all_sites(driver, read_all_expression)
+                        except Exception as e:
+                            print_with_log(f"Bulk read failed, reading sites one by one: {
+                                           str(e)}", True, 'error')
+                            site_texts = [None] * len(sites)
+
+                        # One timestamp for every value read this cycle
+                        now = get_time()
+
+                        texts_by_site = dict(zip(sites, site_texts))
+                        snapshot = []
+                        for tab_selector, tab_sites in sites_by_tab.items():
+                            # Open each tab at most once, and only when a station
+                            # has to be read from the page directly
+                            tab_open = True
+                            if any(site.needs_tab(texts_by_site[site]) for site in tab_sites):
+                                try:
+                                    click_tab(driver, tab_selector)
+                                except Exception as e:
+                                    print_with_log(f"Error opening tab {tab_selector}: {
+                                                   str(e)}", True, 'error')
+                                    tab_open = False
+
+                            for site in tab_sites:
+                                texts = texts_by_site[site]
+                                # Another tab is still showing, so only the bulk
+                                # values can be trusted
+                                if not tab_open and site.needs_tab(texts):
+                                    continue
+                                data = site.fetch_data(driver, now, texts)
+                                if data is not None:
+                                    snapshot.append(data)
+
+                        # All sites of this cycle in one file, written once
+                        write_data(snapshot_path, "\n".join(snapshot))
+
+                        # Write out this cycle's log lines in one go
+                        print_with_log("------------------------------------", False, 'ignore',
+                                       flush=True)
+
+                    except Exception as e:
+                        print_with_log(f"Error occurred: {
+                                       str(e)}", True, 'error', flush=True)
+
+                    # Calculate remaining time to sleep
+                    elapsed_time = time.time() - start_time
+                    sleep_time = max(0, config.loop_time_sec - elapsed_time)
+
+                    # Sleep until the next tick, waking immediately if Esc is pressed
+                    if exit_flag.wait(timeout=sleep_time):
+                        break
+        finally:
+            # Unhook the keyboard even when login or the session fails
+            if esc_hotkey is not None:
+                keyboard.remove_hotkey(esc_hotkey)
+
+        close_data_files()
+
+        print_with_log("Received Esc, Preparing to exit...", True, 'info')
+        print_with_log("------------------------------------", False, 'ignore')
+
+        print_with_log(f"Application Ended", True, 'info')
+        print_with_log("------------------------------------", False, 'ignore')
 
 
 if __name__ == '__main__':